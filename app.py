@@ -5,13 +5,21 @@ import os
 import csv
 import zipfile
 import subprocess
-from collections import deque, defaultdict
+import queue
+from collections import defaultdict
 
-from flask import Flask, render_template, jsonify, send_file
+import numpy as np
+try:
+    from numba import njit
+except ImportError:  # no numba wheel for 32-bit Pi OS; fall back to NumPy (see README)
+    njit = None
+from flask import Flask, Response, render_template, jsonify
+from waitress import serve
 
 import board
 import busio
 from adafruit_ads1x15.ads1115 import ADS1115
+from adafruit_ads1x15.ads1x15 import Mode
 from adafruit_ads1x15.analog_in import AnalogIn
 
 import matplotlib
@@ -24,39 +32,191 @@ from reportlab.lib.pagesizes import letter
 
 # ================= CONFIG =================
 SAMPLE_RATE = 250
+BATCH = 25  # samples processed per block (100 ms)
 R_THRESHOLD = 15000
+MIN_RR_NS = 250_000_000  # refractory period between beats
 
 BRADY_BPM = 50
 TACHY_BPM = 100
 VTACH_BPM = 150
-ASYSTOLE_SEC = 3.5
+ASYSTOLE_NS = 3_500_000_000
 
 RESET_LOCK = threading.Lock()
 
+SMOOTH_WINDOW = 5
+PLOT_POINTS = 1000
+BPM_POINTS = 300  # BPM tail shown on the page and in the report plot
+HISTORY_SAMPLES = SAMPLE_RATE * 600  # 10 min ring buffer
+
+# ================= RING BUFFERS =================
+class RingBuffer:
+    """Fixed-size ring; values() is a zero-copy view in storage order."""
+
+    def __init__(self, size, dtype=np.float64):
+        self.buf = np.empty(size, dtype=dtype)
+        self.count = 0
+
+    def append(self, x):
+        self.buf[self.count % self.buf.shape[0]] = x
+        self.count += 1
+
+    def extend(self, values):
+        size = self.buf.shape[0]
+        n = len(values)
+        values = values[-size:]
+        start = (self.count + n - len(values)) % size
+        first = min(len(values), size - start)
+        self.buf[start:start + first] = values[:first]
+        self.buf[:len(values) - first] = values[first:]
+        self.count += n
+
+    def clear(self):
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.buf.shape[0])
+
+    def values(self):
+        return self.buf[:len(self)]
+
+    def tail(self, n):
+        """Copy of the newest n entries, oldest first."""
+        n = min(n, len(self))
+        end = self.count % self.buf.shape[0]
+        start = end - n
+        if start >= 0:
+            return self.buf[start:end].copy()
+        return np.concatenate((self.buf[start:], self.buf[:end]))
+
+    def ordered(self):
+        """Copy of the contents, oldest first."""
+        return self.tail(len(self))
+
+# ================= STATS =================
+def _mean_var_loop(x):
+    # mean and variance in a single pass
+    n = x.shape[0]
+    total = 0.0
+    total_sq = 0.0
+    for i in range(n):
+        v = x[i]
+        total += v
+        total_sq += v * v
+    mean = total / n
+    return mean, total_sq / n - mean * mean
+
+if njit is not None:
+    _mean_var = njit(cache=True, fastmath=True)(_mean_var_loop)
+else:
+    def _mean_var(x):
+        return x.mean(), x.var()
+
+def _scan_peaks_block(block, ts, last_peak_t, threshold, min_rr):
+    # every above-threshold sample moves the last-peak time; an RR interval
+    # is only recorded when it exceeds min_rr (refractory period)
+    hits = np.nonzero(block > threshold)[0]
+    hit_t = ts[hits]
+    prev = np.empty_like(hit_t)
+    if hit_t.shape[0] > 0:
+        prev[0] = last_peak_t
+        prev[1:] = hit_t[:-1]
+    rr = hit_t - prev
+    keep = (prev > 0) & (rr > min_rr)
+    last_hit = hits[-1] if hits.shape[0] > 0 else -1
+    return hits[keep], rr[keep], last_hit
+
+scan_peaks = njit(cache=True)(_scan_peaks_block) if njit is not None else _scan_peaks_block
+
+# compile now so the sampler never pays JIT latency
+_mean_var(np.ones(2, dtype=np.float64))
+scan_peaks(np.zeros(BATCH, dtype=np.int32), np.zeros(BATCH, dtype=np.int64),
+           0, R_THRESHOLD, MIN_RR_NS)
+
 # ================= GLOBAL STATE =================
-ecg_data = []
-timestamps = []
+ecg_data = RingBuffer(HISTORY_SAMPLES, np.int16)
+timestamps = RingBuffer(HISTORY_SAMPLES, np.int64)  # time.monotonic_ns()
 bpm_history = []
 bpm_timestamps = []
 
-rr_intervals = deque(maxlen=60)
-qrs_widths = deque(maxlen=30)
-qt_intervals = deque(maxlen=30)
+rr_intervals = RingBuffer(60)
+qrs_widths = RingBuffer(30)
+qt_intervals = RingBuffer(30)
+
+# stats over the interval rings, refreshed only when a beat is added
+_rr_mean = _rr_var = 0.0
+_qrs_mean = _qt_mean = 0.0
 
-event_state = {}
 event_counts = defaultdict(int)
-event_timeline = []  # per-sample cardiac flags
+event_timeline = RingBuffer(HISTORY_SAMPLES, np.uint16)  # per-sample EVENT_BIT masks
 
 current_bpm = 0
-last_peak_time = None
-last_signal_time = time.time()
+last_peak_ns = 0
+last_signal_ns = time.monotonic_ns()
 
 running = True
+reset_generation = 0  # bumped by /reset; the sampler drops blocks read across it
+last_reset_ns = 0  # blocks with older samples (e.g. IIO backlog) are dropped
 
 # ================= HARDWARE =================
-i2c = busio.I2C(board.SCL, board.SDA)
-ads = ADS1115(i2c)
-chan = AnalogIn(ads, 0)
+# With the kernel ti-ads1015 IIO driver and a triggered buffer set up (see
+# README), point ECG_IIO_DEVICE at its character device, e.g. /dev/iio:device0.
+# The kernel then owns the I2C transfers and one read() returns a whole block.
+IIO_DEVICE = os.environ.get("ECG_IIO_DEVICE")
+
+# opened by init_hardware(), only in the process that runs the sampler
+chan = None
+iio_fd = None
+
+def read_block_i2c(block, block_ts, next_t):
+    period = 1.0 / SAMPLE_RATE
+    for i in range(BATCH):
+        block[i] = chan.value
+        block_ts[i] = time.monotonic_ns()
+
+        # sleep until the next deadline instead of a fixed period, so the
+        # read/processing time does not accumulate as drift
+        next_t += period
+        slack = next_t - time.monotonic()
+        if slack > 0:
+            time.sleep(slack)
+        else:
+            next_t = time.monotonic()  # fell behind: re-sync
+    return next_t
+
+# one buffered scan: voltage0 (le:s16), padding, kernel timestamp (le:s64)
+IIO_SCAN = np.dtype([("value", "<i2"), ("pad", "V6"), ("ts", "<i8")])
+
+def read_block_iio(block, block_ts, next_t):
+    # The kernel trigger paces conversions; read() blocks until data is
+    # buffered. Timestamps come from the kernel (monotonic clock), so a
+    # backlog that built up while we were busy keeps its real sample times.
+    need = IIO_SCAN.itemsize * BATCH
+    raw = bytearray()
+    while len(raw) < need:
+        chunk = os.read(iio_fd, need - len(raw))
+        if not chunk:
+            raise OSError(f"{IIO_DEVICE}: buffer returned no data")
+        raw += chunk
+    scans = np.frombuffer(raw, dtype=IIO_SCAN)
+    block[:] = scans["value"]
+    block_ts[:] = scans["ts"]
+    return time.monotonic()
+
+def init_hardware():
+    """Open the ADC and return the matching block reader."""
+    global chan, iio_fd
+
+    if IIO_DEVICE:
+        iio_fd = os.open(IIO_DEVICE, os.O_RDONLY)
+        return read_block_iio
+
+    i2c = busio.I2C(board.SCL, board.SDA)
+    ads = ADS1115(i2c)
+    # continuous conversion: each read is a single register fetch, no trigger/poll
+    ads.mode = Mode.CONTINUOUS
+    ads.data_rate = SAMPLE_RATE
+    chan = AnalogIn(ads, 0)
+    return read_block_i2c
 
 # ================= FLASK =================
 app = Flask(__name__)
@@ -77,90 +237,118 @@ CARDIAC_EVENTS = {
     "Myocarditis (possible)"
 }
 
+# one bit per cardiac event; _current_mask holds the OR of the active bits
+# and is what the timeline, /data and the myocarditis score read
+EVENT_BIT = {name: i for i, name in enumerate(sorted(CARDIAC_EVENTS))}
+_current_mask = 0
+
+MYOCARDITIS_MASK = (
+    1 << EVENT_BIT["Tachycardia"]
+    | 1 << EVENT_BIT["Irregular Rhythm"]
+    | 1 << EVENT_BIT["Early Repolarization / ST Elevation (possible)"]
+)
+
 def set_event(name, condition):
+    global _current_mask
+
+    bit = 1 << EVENT_BIT[name]
     if condition:
-        event_state[name] = True
+        _current_mask |= bit
         event_counts[name] += 1
     else:
-        event_state.pop(name, None)
+        _current_mask &= ~bit
 
-def active_cardiac_flags():
-    return [e for e in event_state if e in CARDIAC_EVENTS]
+def decode_flags(mask):
+    return ",".join(n for n, b in EVENT_BIT.items() if mask >> b & 1)
 
 # ================= ECG LOOP =================
-def ecg_loop():
-    global last_peak_time, current_bpm, last_signal_time
+def ecg_loop(read_block):
+    global last_peak_ns, current_bpm, last_signal_ns
+
+    next_t = time.monotonic()
+    block = np.empty(BATCH, dtype=np.int32)
+    block_ts = np.empty(BATCH, dtype=np.int64)
 
     while running:
-        with RESET_LOCK:
-            val = chan.value
-            t = time.time()
+        # -------- ACQUIRE ONE BLOCK --------
+        generation = reset_generation
+        next_t = read_block(block, block_ts, next_t)
 
-            ecg_data.append(val)
-            timestamps.append(t)
+        # Everything below only touches memory, so it runs under RESET_LOCK:
+        # a block that straddles /reset is dropped instead of leaking into
+        # the cleared rings, and snapshots see all rings at the same length.
+        with RESET_LOCK:
+            if generation != reset_generation or block_ts[0] < last_reset_ns:
+                continue
 
             # -------- R-PEAK DETECTION --------
-            if val > R_THRESHOLD:
-                if last_peak_time:
-                    rr = t - last_peak_time
-                    if rr > 0.25:
-                        rr_intervals.append(rr)
-                        bpm = 60 / rr
-                        current_bpm = int(bpm)
-                        bpm_history.append(current_bpm)
-                        bpm_timestamps.append(t)
+            peaks, rr_ns, last_hit = scan_peaks(block, block_ts, last_peak_ns,
+                                                R_THRESHOLD, MIN_RR_NS)
+            for i, rr in zip(peaks.tolist(), (rr_ns * 1e-9).tolist()):
+                rr_intervals.append(rr)
+                bpm = 60 / rr
+                current_bpm = int(bpm)
+                bpm_history.append(current_bpm)
+                bpm_timestamps.append(int(block_ts[i]))
 
-                        # crude QT proxy (relative RR-based)
-                        qt_intervals.append(rr * 0.45)
+                # crude QT proxy (relative RR-based)
+                qt_intervals.append(rr * 0.45)
 
-                        # crude QRS width proxy
-                        qrs_widths.append(0.08 + abs(val - R_THRESHOLD) / 100000)
+                # crude QRS width proxy
+                qrs_widths.append(0.08 + abs(int(block[i]) - R_THRESHOLD) / 100000)
 
-                last_peak_time = t
-                last_signal_time = t
+            if peaks.shape[0]:
+                update_interval_stats()
 
-            detect_events(val, t)
+            if last_hit >= 0:
+                last_peak_ns = int(block_ts[last_hit])
+                last_signal_ns = last_peak_ns
 
-            # Store per-sample cardiac flags
-            event_timeline.append(",".join(active_cardiac_flags()))
+            detect_events(int(block.max()), int(block_ts[-1]))
 
-        time.sleep(1 / SAMPLE_RATE)
+            # Store samples and per-sample cardiac flags
+            ecg_data.extend(block)
+            timestamps.extend(block_ts)
+            event_timeline.extend(np.full(BATCH, _current_mask, dtype=np.uint16))
 
 # ================= EVENT DETECTION =================
-def detect_events(val, now):
+def update_interval_stats():
+    global _rr_mean, _rr_var, _qrs_mean, _qt_mean
+
+    _rr_mean, _rr_var = _mean_var(rr_intervals.values())
+    _qrs_mean = qrs_widths.values().mean()
+    _qt_mean = qt_intervals.values().mean()
+
+def detect_events(val, now_ns):
     # ---- RATE BASED ----
     set_event("Bradycardia", current_bpm and current_bpm < BRADY_BPM)
     set_event("Tachycardia", current_bpm and current_bpm > TACHY_BPM)
     set_event("Ventricular Tachycardia", current_bpm and current_bpm > VTACH_BPM)
 
     # ---- ASYSTOLE ----
-    set_event("Asystole / Flatline", now - last_signal_time > ASYSTOLE_SEC)
+    set_event("Asystole / Flatline", now_ns - last_signal_ns > ASYSTOLE_NS)
 
     # ---- RR VARIABILITY ----
     if len(rr_intervals) > 6:
-        mean_rr = sum(rr_intervals) / len(rr_intervals)
-        variance = sum((r - mean_rr) ** 2 for r in rr_intervals) / len(rr_intervals)
-
-        set_event("Irregular Rhythm", variance > 0.02)
-        set_event("Sinus Node Dysfunction", variance > 0.03 and mean_rr > 1.2)
+        set_event("Irregular Rhythm", _rr_var > 0.02)
+        set_event("Sinus Node Dysfunction", _rr_var > 0.03 and _rr_mean > 1.2)
 
         set_event(
             "First-Degree AV Block (possible)",
-            mean_rr > 1.0 and variance < 0.005
+            _rr_mean > 1.0 and _rr_var < 0.005
         )
 
     # ---- QRS MORPHOLOGY ----
     if len(qrs_widths) > 5:
         set_event(
             "Bundle Branch Block (possible)",
-            sum(qrs_widths) / len(qrs_widths) > 0.14
+            _qrs_mean > 0.14
         )
 
     # ---- QT HEURISTICS (NEEDS CALIBRATION) ----
     if len(qt_intervals) > 5:
-        avg_qt = sum(qt_intervals) / len(qt_intervals)
-        set_event("Long QT (possible)", avg_qt > 0.48)
-        set_event("Short QT (possible)", avg_qt < 0.32)
+        set_event("Long QT (possible)", _qt_mean > 0.48)
+        set_event("Short QT (possible)", _qt_mean < 0.32)
 
     # ---- ST / REPOLARIZATION ----
     set_event(
@@ -169,10 +357,7 @@ def detect_events(val, now):
     )
 
     # ---- MYOCARDITIS HEURISTIC ----
-    myocarditis_score = 0
-    if "Tachycardia" in event_state: myocarditis_score += 1
-    if "Irregular Rhythm" in event_state: myocarditis_score += 1
-    if "Early Repolarization / ST Elevation (possible)" in event_state: myocarditis_score += 1
+    myocarditis_score = bin(_current_mask & MYOCARDITIS_MASK).count("1")
 
     set_event("Myocarditis (possible)", myocarditis_score >= 2)
 
@@ -183,22 +368,40 @@ def index():
 
 @app.route("/data")
 def data():
+    # only the tail copy is locked; smoothing runs outside the critical section
     with RESET_LOCK:
-        smoothed = []
-        w = 5
-        for i in range(len(ecg_data)):
-            smoothed.append(sum(ecg_data[max(0, i-w):i+1]) / min(i+1, w))
-
-        return jsonify({
-            "ecg": smoothed[-1000:],
-            "bpm": current_bpm,
-            "bpm_history": bpm_history[-300:],
-            "events": list(event_state.keys())
-        })
+        tail = ecg_data.tail(PLOT_POINTS + SMOOTH_WINDOW - 1).astype(np.float32)
+        bpm = current_bpm
+        history = bpm_history[-BPM_POINTS:]
+        events_mask = _current_mask
+
+    # moving average over the plotted tail only (window-1 extra samples)
+    kernel = np.ones(SMOOTH_WINDOW, dtype=np.float32) / SMOOTH_WINDOW
+    if tail.size >= SMOOTH_WINDOW:
+        smoothed = np.convolve(tail, kernel, mode="valid")[-PLOT_POINTS:].tolist()
+    else:
+        smoothed = []  # just started or reset: not a full window yet
+
+    return jsonify({
+        "ecg": smoothed,
+        "bpm": bpm,
+        "bpm_history": history,
+        "events_mask": events_mask
+    })
+
+@app.route("/events_map")
+def events_map():
+    # bit -> name table; the page decodes events_mask from /data with it
+    return jsonify(EVENT_BIT)
 
 @app.route("/reset", methods=["POST"])
 def reset():
+    global reset_generation, last_reset_ns, _current_mask
+    global current_bpm, last_peak_ns, last_signal_ns
+
     with RESET_LOCK:
+        reset_generation += 1
+        last_reset_ns = time.monotonic_ns()
         ecg_data.clear()
         timestamps.clear()
         bpm_history.clear()
@@ -206,9 +409,12 @@ def reset():
         rr_intervals.clear()
         qrs_widths.clear()
         qt_intervals.clear()
-        event_state.clear()
+        _current_mask = 0
         event_counts.clear()
         event_timeline.clear()
+        current_bpm = 0
+        last_peak_ns = 0
+        last_signal_ns = time.monotonic_ns()
     return ("", 204)
 
 @app.route("/shutdown", methods=["POST"])
@@ -217,89 +423,243 @@ def shutdown():
     return ("", 204)
 
 # ================= REPORT ZIP =================
+REPORT_CHUNK = 64 * 1024
+
+def write_csv(fh, header, *columns):
+    """Write array columns as CSV rows into the binary stream fh."""
+    # buffer so the zip member compresses/CRCs REPORT_CHUNK at a time, not per row
+    buffered = io.BufferedWriter(fh, REPORT_CHUNK)
+    with io.TextIOWrapper(buffered, encoding="utf-8", newline="") as text:
+        writer = csv.writer(text)
+        writer.writerow(header)
+        # columns are snapshotted together under RESET_LOCK: same length
+        writer.writerows(zip(*(c.tolist() for c in columns)))
+
+def epoch_seconds(ts_ns, wall_offset_ns):
+    """Monotonic ns stamps to Unix seconds, the format the analyser app reads."""
+    return (np.asarray(ts_ns, dtype=np.int64) + wall_offset_ns) * 1e-9
+
+def flag_column(masks):
+    """Decode per-sample event masks to flag names, once per distinct mask."""
+    uniq, inverse = np.unique(masks, return_inverse=True)
+    names = np.array([decode_flags(m) for m in uniq.tolist()], dtype=object)
+    return names[inverse]
+
+# figures are created once and redrawn per report; pyplot is not thread-safe
+PLOT_LOCK = threading.Lock()
+_ecg_fig, _ecg_ax = plt.subplots(figsize=(6,3))
+_bpm_fig, _bpm_ax = plt.subplots(figsize=(6,2))
+
+def render_png(fig, ax, y, title):
+    with PLOT_LOCK:
+        ax.clear()
+        ax.plot(y)
+        ax.set_title(title)
+        fig.tight_layout()
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png")
+    return buf.getvalue()
+
+def render_pdf(counts):
+    pdf_buf = io.BytesIO()
+    doc = SimpleDocTemplate(pdf_buf, pagesize=letter)
+    styles = getSampleStyleSheet()
+    elements = []
+
+    elements.append(Paragraph("ECG Monitoring Summary", styles["Title"]))
+    elements.append(Spacer(1,12))
+
+    total = max(sum(counts.values()),1)
+    sorted_events = sorted(counts.items(), key=lambda x: x[1], reverse=True)
+
+    for e, c in sorted_events:
+        if e in CARDIAC_EVENTS:
+            pct = (c / total) * 100
+            if pct > 0:
+                concern = "Normal"
+                if pct > 20: concern = " Elevated!!!"
+                if pct > 40: concern = " High!!!"
+                elements.append(Paragraph(f"{e}: {pct:.1f}% — {concern}", styles["Normal"]))
+                elements.append(Paragraph(f"Explanation: This flag indicates {e.lower()} was detected in the session. Higher percentages suggest more frequent abnormality.", styles["Italic"]))
+                elements.append(Spacer(1,6))
+
+    doc.build(elements)
+    return pdf_buf.getvalue()
+
+def load_software_files(folder="software"):
+    """Read the bundled software folder once so /report does not re-walk the disk."""
+    files = []
+    if os.path.isdir(folder):
+        for root, _, names in os.walk(folder):
+            for f in names:
+                path = os.path.join(root, f)
+                with open(path, "rb") as fh:
+                    files.append((path, fh.read()))
+    return files
+
+_SOFTWARE_FILES = load_software_files()
+
+# already-compressed formats are stored as-is; text gets a fast DEFLATE
+STORED_EXTENSIONS = (".png", ".pdf", ".zip")
+
+def add_to_zip(zipf, name, data):
+    if name.lower().endswith(STORED_EXTENSIONS):
+        zipf.writestr(name, data, compress_type=zipfile.ZIP_STORED)
+    else:
+        zipf.writestr(name, data, compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+# rendered plots/PDF, reused while the recording has not advanced; stored as
+# one (key, files) tuple so readers never pair a key with another key's files
+_report_cache = (None, {})
+REPORT_CACHE_LOCK = threading.Lock()
+
+def report_artifacts(key, ecg_snapshot, bpm_snapshot, counts):
+    global _report_cache
+
+    with REPORT_CACHE_LOCK:
+        cached_key, files = _report_cache
+        if key != cached_key:
+            files = {}
+            if ecg_snapshot.size:
+                files["ecg_snapshot.png"] = render_png(
+                    _ecg_fig, _ecg_ax, ecg_snapshot[-PLOT_POINTS:], "ECG Snapshot"
+                )
+            if bpm_snapshot.size:
+                files["bpm_snapshot.png"] = render_png(
+                    _bpm_fig, _bpm_ax, bpm_snapshot[-BPM_POINTS:], "BPM Over Time"
+                )
+            files["report.pdf"] = render_pdf(counts)
+            _report_cache = (key, files)
+    return files
+
+class StreamBuf(io.RawIOBase):
+    """Write-only, unseekable sink that hands REPORT_CHUNK-sized pieces to a queue."""
+
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.pending = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.pending += b
+        if len(self.pending) >= REPORT_CHUNK:
+            self.put(bytes(self.pending))
+            self.pending.clear()
+        return len(b)
+
+    def put(self, item):
+        # bounded queue: block while the client catches up, give up if it left
+        while True:
+            try:
+                self.chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                if self.cancelled.is_set():
+                    raise OSError("report download cancelled")
+
+    def close(self):
+        if not self.closed and self.pending:
+            self.put(bytes(self.pending))
+            self.pending.clear()
+        super().close()
+
+def stream_zip(build):
+    """Run build(zipf) on a worker thread and yield the archive as it is written."""
+    chunks = queue.Queue(maxsize=8)
+    cancelled = threading.Event()
+
+    def worker():
+        sink = StreamBuf(chunks, cancelled)
+        try:
+            with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zipf:
+                build(zipf)
+            sink.close()
+            end = None
+        except Exception as exc:
+            end = exc  # re-raised by the generator so the download fails loudly
+        if not cancelled.is_set():
+            try:
+                sink.put(end)
+            except OSError:
+                pass  # client went away meanwhile
+
+    threading.Thread(target=worker, daemon=True).start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        cancelled.set()
+
 @app.route("/report")
 def report():
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-
+    with RESET_LOCK:
+        key = (ecg_data.count, tuple(timestamps.tail(1).tolist()), len(bpm_history))
+        ecg_snapshot = ecg_data.ordered()
+        ts_snapshot = timestamps.ordered()
+        # map monotonic ns to wall clock only here, for the CSVs
+        wall_offset_ns = time.time_ns() - time.monotonic_ns()
+        flags_snapshot = event_timeline.ordered()
+        bpm_snapshot = np.asarray(bpm_history)
+        bpm_ts_snapshot = np.asarray(bpm_timestamps, dtype=np.int64)
+        counts_snapshot = dict(event_counts)
+
+    def build(zipf):
         # -------- ECG CSV (WITH FLAGS) --------
-        ecg_csv = io.StringIO()
-        writer = csv.writer(ecg_csv)
-        writer.writerow(["timestamp", "ecg_value", "cardiac_flags"])
-        for t, v, f in zip(timestamps, ecg_data, event_timeline):
-            writer.writerow([t, v, f])
-        zipf.writestr("ecg_data_with_flags.csv", ecg_csv.getvalue())
+        with zipf.open("ecg_data_with_flags.csv", "w", force_zip64=True) as fh:
+            write_csv(fh, ["timestamp", "ecg_value", "cardiac_flags"],
+                      epoch_seconds(ts_snapshot, wall_offset_ns), ecg_snapshot,
+                      flag_column(flags_snapshot))
 
         # -------- BPM CSV --------
-        bpm_csv = io.StringIO()
-        writer = csv.writer(bpm_csv)
-        writer.writerow(["timestamp", "bpm"])
-        for t, b in zip(bpm_timestamps, bpm_history):
-            writer.writerow([t, b])
-        zipf.writestr("bpm_data.csv", bpm_csv.getvalue())
-
-        # -------- PLOT SNAPSHOTS --------
-        if ecg_data:
-            plt.figure(figsize=(6,3))
-            plt.plot(ecg_data[-1000:])
-            plt.title("ECG Snapshot")
-            plt.tight_layout()
-            buf = io.BytesIO()
-            plt.savefig(buf, format="png")
-            plt.close()
-            buf.seek(0)
-            zipf.writestr("ecg_snapshot.png", buf.read())
-
-        if bpm_history:
-            plt.figure(figsize=(6,2))
-            plt.plot(bpm_history[-300:])
-            plt.title("BPM Over Time")
-            plt.tight_layout()
-            buf = io.BytesIO()
-            plt.savefig(buf, format="png")
-            plt.close()
-            buf.seek(0)
-            zipf.writestr("bpm_snapshot.png", buf.read())
-
-        # -------- PDF REPORT --------
-        pdf_buf = io.BytesIO()
-        doc = SimpleDocTemplate(pdf_buf, pagesize=letter)
-        styles = getSampleStyleSheet()
-        elements = []
-
-        elements.append(Paragraph("ECG Monitoring Summary", styles["Title"]))
-        elements.append(Spacer(1,12))
-
-        total = max(sum(event_counts.values()),1)
-        sorted_events = sorted(event_counts.items(), key=lambda x: x[1], reverse=True)
-
-        for e, c in sorted_events:
-            if e in CARDIAC_EVENTS:
-                pct = (c / total) * 100
-                if pct > 0:
-                    concern = "Normal"
-                    if pct > 20: concern = " Elevated!!!"
-                    if pct > 40: concern = " High!!!"
-                    elements.append(Paragraph(f"{e}: {pct:.1f}% — {concern}", styles["Normal"]))
-                    elements.append(Paragraph(f"Explanation: This flag indicates {e.lower()} was detected in the session. Higher percentages suggest more frequent abnormality.", styles["Italic"]))
-                    elements.append(Spacer(1,6))
-
-        doc.build(elements)
-        pdf_buf.seek(0)
-        zipf.writestr("report.pdf", pdf_buf.read())
+        with zipf.open("bpm_data.csv", "w", force_zip64=True) as fh:
+            write_csv(fh, ["timestamp", "bpm"],
+                      epoch_seconds(bpm_ts_snapshot, wall_offset_ns), bpm_snapshot)
+
+        # -------- PLOT SNAPSHOTS + PDF REPORT --------
+        for name, data in report_artifacts(key, ecg_snapshot, bpm_snapshot, counts_snapshot).items():
+            add_to_zip(zipf, name, data)
 
         # -------- SOFTWARE FOLDER --------
-        if os.path.isdir("software"):
-            for root, _, files in os.walk("software"):
-                for f in files:
-                    path = os.path.join(root,f)
-                    zipf.write(path, arcname=path)
+        for path, content in _SOFTWARE_FILES:
+            add_to_zip(zipf, path, content)
 
-    zip_buffer.seek(0)
-    return send_file(zip_buffer, download_name="ecg_report_bundle.zip", as_attachment=True)
+    return Response(
+        stream_zip(build),
+        mimetype="application/zip",
+        headers={"Content-Disposition": "attachment; filename=ecg_report_bundle.zip"}
+    )
 
 # ================= START =================
-threading.Thread(target=ecg_loop, daemon=True).start()
+# Only one process may own the ADC. Set ECG_SAMPLER=0 when importing the app
+# somewhere that must not sample (e.g. a WSGI master that forks workers); the
+# ADC is then never opened or reconfigured by that process.
+# The guard is per module object: loading this file a second time (e.g. as
+# both __main__ and app) would give a second app with its own, unfed buffers,
+# so run it one way only (python3 app.py, or a WSGI server importing app).
+_sampler_lock = threading.Lock()
+_sampler_started = False
+
+def start_sampler():
+    # a second sampler would reconfigure the ADC and fight the first over it
+    global _sampler_started
+
+    with _sampler_lock:
+        if _sampler_started:
+            return
+        read_block = init_hardware()
+        threading.Thread(target=ecg_loop, args=(read_block,), daemon=True).start()
+        _sampler_started = True
+
+if os.environ.get("ECG_SAMPLER", "1") != "0":
+    start_sampler()
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
+    serve(app, host="0.0.0.0", port=5000, threads=4)